@@ -33,9 +33,9 @@ class EfficientNetClassifier(nn.Module):
     def extract_features(self, x):
         return self.efficientnet(x)
     
-def get_model(num_classes):
-    model = EfficientNetClassifier(num_classes)
-    return model.to(Config.DEVICE)
+def get_model(num_classes, device=None, pretrained=True):
+    model = EfficientNetClassifier(num_classes, pretrained=pretrained)
+    return model.to(device or Config.DEVICE)
 
 def load_checkpoint(model, checkpoint_path):
     model.load_state_dict(torch.load(checkpoint_path))
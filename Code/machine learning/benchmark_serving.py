@@ -0,0 +1,77 @@
+import os
+import time
+import statistics
+import argparse
+from concurrent.futures import wait
+from serving import PreforkServer
+
+def memory_mb(pid):
+    # PSS splits shared pages between the processes mapping them, so summing
+    # it over the pool gives the real memory cost; private pages show what
+    # each worker adds on top of the shared weights
+    memory = {'pss': 0, 'private': 0}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            key, value = line.split()[:2]
+            if key == 'Pss:':
+                memory['pss'] += int(value) / 1024
+            elif key in ('Private_Clean:', 'Private_Dirty:'):
+                memory['private'] += int(value) / 1024
+    return memory
+
+def collect_images(image_dir, limit):
+    image_paths = []
+
+    for root, _, files in os.walk(image_dir):
+        for file in files:
+            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                image_paths.append(os.path.join(root, file))
+
+    images = []
+    for image_path in sorted(image_paths)[:limit]:
+        with open(image_path, 'rb') as f:
+            images.append(f.read())
+    return images
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_path', type=str)
+    parser.add_argument('image_dir', type=str)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--num_images', type=int, default=512)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    images = collect_images(args.image_dir, args.num_images)
+    if not images:
+        print(f"No images found in {args.image_dir}")
+        return
+
+    print(f"{'workers':>8} {'images/s':>10} {'speedup':>8} {'PSS MB':>8} {'private MB/worker':>18}")
+    baseline = None
+    for num_workers in args.workers:
+        server = PreforkServer(args.model_path, num_workers, args.threads_per_worker)
+        server.start()
+
+        # One full pass warms every worker's allocator and caches, then the
+        # median of several passes smooths out noisy neighbours
+        wait([server.submit(image) for image in images])
+
+        rates = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            wait([server.submit(image) for image in images])
+            rates.append(len(images) / (time.perf_counter() - start))
+        throughput = statistics.median(rates)
+
+        workers = [memory_mb(worker.pid) for worker in server.workers]
+        pss = memory_mb(os.getpid())['pss'] + sum(worker['pss'] for worker in workers)
+        private = sum(worker['private'] for worker in workers) / len(workers)
+        server.stop()
+
+        baseline = baseline or throughput
+        print(f"{num_workers:>8} {throughput:>10.1f} {throughput / baseline:>8.2f} {pss:>8.0f} {private:>18.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import tempfile
+import time
+import numpy as np
+from config import Config
+from similarity import EmbeddingStore, IVFIndex, brute_force_search_rows, normalize
+
+def synthetic_embeddings(rng, centers, basis, n, spread=1.0, decay=0.3, residual=0.3):
+    # CNN embeddings cluster by disease and plant and have a slowly decaying
+    # spectrum. The latent subspace is wider than the PCA codes and every
+    # direction carries residual noise, so the reduction really loses energy.
+    labels = rng.integers(len(centers), size=n)
+    scales = (1 + np.arange(basis.shape[0], dtype=np.float32)) ** -decay
+    scales *= spread / np.linalg.norm(scales)
+    latent = rng.standard_normal((n, basis.shape[0]), dtype=np.float32) * scales
+    noise = rng.standard_normal((n, basis.shape[1]), dtype=np.float32) * (residual / np.sqrt(basis.shape[1]))
+    return normalize(centers[labels] + latent @ basis + noise)
+
+def build_store(store, rng, centers, basis, num_vectors, chunk_size=50000):
+    for start in range(0, num_vectors, chunk_size):
+        n = min(chunk_size, num_vectors - start)
+        store.append(synthetic_embeddings(rng, centers, basis, n), [f"scan_{start + i}" for i in range(n)])
+        print(f"Stored {start + n}/{num_vectors} embeddings", end='\r')
+    print()
+
+def recall_at_k(approx_rows, exact_rows):
+    hits = [len(np.intersect1d(a, e)) / len(e) for a, e in zip(approx_rows, exact_rows)]
+    return float(np.mean(hits))
+
+def drop_rows(rows, exclude, k):
+    return [r[r != e][:k] for r, e in zip(rows, exclude)]
+
+def run_benchmark(args, store_dir, synthetic):
+    rng = np.random.default_rng(Config.RANDOM_SEED)
+    store = EmbeddingStore(store_dir)
+
+    if synthetic:
+        centers = normalize(rng.standard_normal((args.num_clusters, Config.EMBEDDING_DIM), dtype=np.float32))
+        basis = np.linalg.qr(rng.standard_normal((Config.EMBEDDING_DIM, args.intrinsic_dim)))[0].T.astype(np.float32)
+        build_store(store, rng, centers, basis, args.num_vectors)
+    elif len(store) == 0:
+        print(f"No embeddings found in {store_dir}")
+        return
+
+    index = IVFIndex(store, nlist=args.nlist)
+
+    start = time.perf_counter()
+    index.train()
+    print(f"Trained {index.nlist} lists in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    index.sync()
+    print(f"Indexed {index.ntotal} embeddings in {time.perf_counter() - start:.1f}s")
+
+    if synthetic:
+        incremental = synthetic_embeddings(rng, centers, basis, 1000)
+        start = time.perf_counter()
+        index.add(incremental, [f"incremental_{i}" for i in range(len(incremental))])
+        print(f"Inserted {len(incremental)} embeddings incrementally in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        # Fresh draws from the same distribution are held out by construction
+        queries = synthetic_embeddings(rng, centers, basis, args.num_queries)
+        exclude = np.full(len(queries), -1)
+    else:
+        # Query with stored scans and drop each query's own row from both
+        # result lists, so recall is measured against its real neighbours
+        exclude = np.sort(rng.choice(len(store), size=min(args.num_queries, len(store)), replace=False))
+        queries = np.asarray(store.vectors[exclude])
+
+    start = time.perf_counter()
+    exact_rows, _ = brute_force_search_rows(store, queries, k=args.k + 1)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    exact_rows = drop_rows(exact_rows, exclude, args.k)
+    print(f"Brute force: {exact_ms:.2f} ms/query")
+
+    print(f"\n{'nprobe':>8} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for nprobe in args.nprobe:
+        approx_rows = []
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            rows, _ = index.search_rows(query, k=args.k + 1, nprobe=nprobe, rerank=args.rerank)
+            latencies.append((time.perf_counter() - start) * 1000)
+            approx_rows.append(rows)
+
+        recall = recall_at_k(drop_rows(approx_rows, exclude, args.k), exact_rows)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{nprobe:>8} {recall:>10.4f} {p50:>8.2f} {p99:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_vectors', type=int, default=1000000)
+    parser.add_argument('--num_queries', type=int, default=200)
+    parser.add_argument('--num_clusters', type=int, default=100)
+    parser.add_argument('--intrinsic_dim', type=int, default=512)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=Config.SIMILARITY_NLIST)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32, 64])
+    parser.add_argument('--rerank', type=int, default=None)
+    parser.add_argument('--store_dir', type=str, default=None)
+    args = parser.parse_args()
+
+    # An existing store, such as the one predection.py fills, is benchmarked
+    # as it is; otherwise a synthetic one is built and thrown away
+    if args.store_dir:
+        run_benchmark(args, args.store_dir, synthetic=False)
+        return
+
+    # A million embeddings take about 5 GB, so never leave them behind
+    with tempfile.TemporaryDirectory(prefix='embeddings_') as store_dir:
+        run_benchmark(args, store_dir, synthetic=True)
+
+if __name__ == "__main__":
+    main()
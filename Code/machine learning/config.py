@@ -21,6 +21,20 @@ class Config:
     
     EFFICIENTNET_VERSION = 'efficientnet-b0'
     
+    EMBEDDINGS_DIR = os.path.join(DATA_DIR, 'embeddings')
+    EMBEDDING_DIM = 1280
+    SIMILARITY_INDEX_PATH = os.path.join(EMBEDDINGS_DIR, 'ivf_index.npz')
+    SIMILARITY_NLIST = 1024
+    SIMILARITY_NPROBE = 16
+    SIMILARITY_PCA_DIM = 128
+    SIMILARITY_RERANK = 500
+    SIMILARITY_MIN_TRAIN_SIZE = 40000
+    
+    SERVING_PORT = 5000
+    SERVING_THREADS_PER_WORKER = 1
+    SERVING_REQUEST_TIMEOUT = 30
+    SERVING_SHUTDOWN_TIMEOUT = 10
+    
     RUN_ID = datetime.now().strftime('%Y%m%d_%H%M%S')
     CHECKPOINT_PATH = os.path.join(MODELS_DIR, f'efficientnet_{RUN_ID}.pth')
     
@@ -4,20 +4,23 @@ import numpy as np
 from PIL import Image
 from torchvision import transforms
 from config import Config
-from model import get_model
+from architecture import get_model
+from similarity import open_index, save_index
 
-def load_model(model_path):
-    checkpoint = torch.load(model_path)
+def load_model(model_path, device=None):
+    device = device or Config.DEVICE
+    checkpoint = torch.load(model_path, map_location=device)
     num_classes = checkpoint['num_classes']
     class_names = checkpoint['class_names']
     
-    model = get_model(num_classes)
+    # The checkpoint overwrites every weight, so skip downloading ImageNet ones
+    model = get_model(num_classes, device, pretrained=False)
     model.load_state_dict(checkpoint['model_state_dict'])
     model.eval()
     
     return model, class_names
 
-def preprocess_image(image_path):
+def preprocess_image(image_path, device=None):
     transform = transforms.Compose([
         transforms.Resize((Config.IMAGE_SIZE[0] + 32, Config.IMAGE_SIZE[1] + 32)),
         transforms.CenterCrop(Config.IMAGE_SIZE),
@@ -26,15 +29,29 @@ def preprocess_image(image_path):
     ])
     
     img = Image.open(image_path).convert('RGB')
-    img_tensor = transform(img).unsqueeze(0).to(Config.DEVICE)
+    img_tensor = transform(img).unsqueeze(0).to(device or Config.DEVICE)
     
     return img_tensor
 
-def predict_single_image(model, image_path, class_names):
-    img_tensor = preprocess_image(image_path)
+def extract_embedding(model, image_path):
+    img_tensor = preprocess_image(image_path, next(model.parameters()).device)
     
     with torch.no_grad():
-        outputs = model(img_tensor)
+        features = model.extract_features(img_tensor)
+        features = torch.nn.functional.normalize(features, dim=1)
+    
+    return features.cpu().numpy()[0]
+
+def find_similar_scans(model, index, image_path, k=5):
+    embedding = extract_embedding(model, image_path)
+    return index.search(embedding, k=k)
+
+def predict_single_image(model, image_path, class_names, index=None):
+    img_tensor = preprocess_image(image_path, next(model.parameters()).device)
+    
+    with torch.no_grad():
+        features = model.extract_features(img_tensor)
+        outputs = model.classifier(features)
         probs = torch.nn.functional.softmax(outputs, dim=1)[0]
         
         top5_probs, top5_indices = torch.topk(probs, 5)
@@ -47,14 +64,24 @@ def predict_single_image(model, image_path, class_names):
                 'probability': prob.item()
             })
     
+    # Scans are keyed by image path, so scoring the same image again (for
+    # example re-running main) does not store a duplicate
+    if index is not None and image_path not in index.store:
+        # The prediction has already succeeded, so a failure to record the
+        # scan must not turn it into an error
+        try:
+            index.add(features.cpu().numpy(), [image_path])
+        except Exception as e:
+            print(f"Could not record embedding for {image_path}: {e}")
+    
     return results
 
-def predict_batch(model, image_paths, class_names):
+def predict_batch(model, image_paths, class_names, index=None):
     all_results = []
     
     for image_path in image_paths:
         try:
-            result = predict_single_image(model, image_path, class_names)
+            result = predict_single_image(model, image_path, class_names, index)
             all_results.append({
                 'image_path': image_path,
                 'predictions': result
@@ -84,7 +111,13 @@ def main():
             if file.lower().endswith(('.jpg', '.jpeg', '.png')):
                 image_paths.append(os.path.join(root, file))
     
-    results = predict_batch(model, image_paths, class_names)
+    index = open_index()
+    results = predict_batch(model, image_paths, class_names, index)
+    
+    if save_index(index):
+        print(f"Similarity index holds {index.ntotal} scans")
+    else:
+        print(f"Stored {len(index.store)} scan embeddings; the similarity index is built once there are {Config.SIMILARITY_MIN_TRAIN_SIZE}")
     
     for result in results:
         if 'error' in result:
@@ -0,0 +1,388 @@
+import os
+import gc
+import io
+import json
+import math
+import time
+import argparse
+import itertools
+import threading
+import multiprocessing as mp
+from multiprocessing import forkserver
+from multiprocessing.connection import wait
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import torch
+from PIL import UnidentifiedImageError
+from flask import Flask, Response, request, jsonify
+from config import Config
+from architecture import get_model
+from predection import load_model, predict_single_image
+
+def _worker_loop(model, class_names, cpus, num_threads, task_queue, result_conn):
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        task_id, image = task
+        if isinstance(image, bytes):
+            image = io.BytesIO(image)
+
+        # The response body is built here so the parent never formats JSON
+        # under its own GIL
+        try:
+            predictions = predict_single_image(model, image, class_names)
+            result_conn.send((task_id, json.dumps({'predictions': predictions}), None, False))
+        except UnidentifiedImageError:
+            result_conn.send((task_id, None, "Uploaded file is not a readable image", True))
+        except Exception as e:
+            result_conn.send((task_id, None, str(e), False))
+
+def _share_state(model):
+    # Pack every parameter and buffer into one shared block per dtype, so the
+    # whole model reaches a new process as a couple of file descriptors
+    state = list(model.state_dict(keep_vars=True).items())
+    blocks = {}
+    for dtype in {tensor.dtype for _, tensor in state}:
+        size = sum(tensor.numel() for _, tensor in state if tensor.dtype == dtype)
+        blocks[str(dtype)] = torch.empty(size, dtype=dtype).share_memory_()
+
+    layout = []
+    offsets = dict.fromkeys(blocks, 0)
+    for name, tensor in state:
+        key = str(tensor.dtype)
+        layout.append((name, key, offsets[key], tuple(tensor.shape)))
+        offsets[key] += tensor.numel()
+
+    _attach_state(model, layout, blocks, copy=True)
+    return layout, blocks
+
+def _attach_state(model, layout, blocks, copy=False):
+    with torch.no_grad():
+        for name, key, offset, shape in layout:
+            module_name, _, attr = name.rpartition('.')
+            module = model.get_submodule(module_name)
+            view = blocks[key][offset:offset + math.prod(shape)].view(shape)
+
+            if attr in module._parameters:
+                if copy:
+                    view.copy_(module._parameters[attr])
+                module._parameters[attr].data = view
+            else:
+                if copy:
+                    view.copy_(module._buffers[attr])
+                module._buffers[attr] = view
+
+def _respawned_worker_loop(layout, blocks, class_names, *args):
+    model = get_model(len(class_names), 'cpu', pretrained=False)
+    _attach_state(model, layout, blocks)
+    model.eval()
+    _worker_loop(model, class_names, *args)
+
+class WorkerUnavailableError(RuntimeError):
+    pass
+
+class InvalidImageError(ValueError):
+    pass
+
+class PreforkServer:
+    def __init__(self, model_path, num_workers=None, threads_per_worker=None):
+        cpus = sorted(os.sched_getaffinity(0))
+        self.threads_per_worker = threads_per_worker or Config.SERVING_THREADS_PER_WORKER
+        self.num_workers = num_workers or max(1, len(cpus) // self.threads_per_worker)
+        self.cpu_sets = []
+        for i in range(self.num_workers):
+            start = i * self.threads_per_worker
+            self.cpu_sets.append({cpus[(start + j) % len(cpus)] for j in range(self.threads_per_worker)})
+
+        # Keep the parent single threaded so no OpenMP pool exists at fork
+        # time, then load the weights once; workers see the same pages. CUDA
+        # contexts do not survive fork, so pre-fork serving is CPU only.
+        torch.set_num_threads(1)
+        self.model, self.class_names = load_model(model_path, device='cpu')
+        self.layout, self.blocks = _share_state(self.model)
+
+        # The first workers are forked straight from the parent. Replacements
+        # are needed once the watcher and Flask threads are running, and
+        # forking a threaded process can leave locks held in the child, so
+        # they come from a fork server instead and map the shared blocks.
+        self.context = mp.get_context('fork')
+        self.respawn_context = mp.get_context('forkserver')
+        self.respawn_context.set_forkserver_preload([__name__])
+        self.task_queues = [None] * self.num_workers
+        self.result_conns = [None] * self.num_workers
+        self.workers = [None] * self.num_workers
+        self.started_at = [0.0] * self.num_workers
+        self.respawn_at = [None] * self.num_workers
+        self.restarts = [0] * self.num_workers
+
+        self.lock = threading.Lock()
+        self.spawn_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.closed = threading.Event()
+        self.wakeup_reader, self.wakeup_writer = self.context.Pipe(duplex=False)
+        self.task_ids = itertools.count()
+        self.pending = {}
+        self.in_flight = [0] * self.num_workers
+        self.alive = [False] * self.num_workers
+        self.watcher = None
+
+    def _spawn_worker(self, worker_id, context):
+        # Keep the garbage collector from writing to inherited objects, which
+        # would otherwise copy their pages into every worker
+        gc.collect()
+        gc.freeze()
+
+        # Each worker writes to its own pipe, so a worker killed mid-write
+        # cannot hold a lock that every other worker needs
+        task_queue = context.Queue()
+        result_reader, result_writer = context.Pipe(duplex=False)
+        worker_args = (self.cpu_sets[worker_id], self.threads_per_worker, task_queue, result_writer)
+        if context is self.context:
+            worker = context.Process(
+                target=_worker_loop,
+                args=(self.model, self.class_names) + worker_args,
+                daemon=True
+            )
+        else:
+            worker = context.Process(
+                target=_respawned_worker_loop,
+                args=(self.layout, self.blocks, self.class_names) + worker_args,
+                daemon=True
+            )
+        worker.start()
+        # Only the worker may hold the write end, so its death closes the pipe
+        result_writer.close()
+
+        with self.lock:
+            self.task_queues[worker_id] = task_queue
+            self.result_conns[worker_id] = result_reader
+            self.workers[worker_id] = worker
+            self.started_at[worker_id] = time.monotonic()
+            self.respawn_at[worker_id] = None
+            self.in_flight[worker_id] = 0
+            self.alive[worker_id] = True
+
+    def start(self):
+        for worker_id in range(self.num_workers):
+            self._spawn_worker(worker_id, self.context)
+
+        # Start the fork server now rather than on the first restart; it is
+        # exec'd, not forked, so it inherits nothing from this process
+        forkserver.ensure_running()
+
+        # The first workers are forked before any helper thread exists
+        self.watcher = threading.Thread(target=self._watch_workers, daemon=True)
+        self.watcher.start()
+
+    def stop(self, timeout=None):
+        if timeout is None:
+            timeout = Config.SERVING_SHUTDOWN_TIMEOUT
+
+        # Holding the spawn lock guarantees no replacement is half started
+        self.stopping.set()
+        with self.spawn_lock:
+            workers = list(self.workers)
+            task_queues = list(self.task_queues)
+
+        for task_queue in task_queues:
+            try:
+                task_queue.put(None)
+            except ValueError:
+                # Closed when its worker exited
+                pass
+
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+
+        for worker_id, worker in enumerate(workers):
+            if worker.is_alive():
+                print(f"Worker {worker_id} did not exit within {timeout}s, terminating")
+                worker.terminate()
+                worker.join(1.0)
+            if worker.is_alive():
+                # A stopped process only acts on SIGKILL
+                worker.kill()
+                worker.join()
+
+        self.closed.set()
+        self.wakeup_writer.send(None)
+        self.watcher.join()
+        self._fail_pending(range(self.num_workers), "Server stopped")
+
+    def submit(self, image):
+        future = Future()
+
+        with self.lock:
+            candidates = [i for i in range(self.num_workers) if self.alive[i]]
+            if not candidates:
+                raise WorkerUnavailableError("No inference workers are running")
+
+            worker_id = min(candidates, key=lambda i: self.in_flight[i])
+            task_queue = self.task_queues[worker_id]
+            task_id = next(self.task_ids)
+            self.pending[task_id] = (worker_id, future)
+            self.in_flight[worker_id] += 1
+
+        task_queue.put((task_id, image))
+        return future
+
+    def predict(self, image, timeout=None):
+        return self.submit(image).result(timeout)
+
+    def _watch_workers(self):
+        # One thread waits on every result pipe and every process sentinel, so
+        # a dead worker is noticed straight away however busy the others are
+        while not self.closed.is_set():
+            with self.lock:
+                conns = [conn for worker_id, conn in enumerate(self.result_conns) if self.alive[worker_id]]
+                sentinels = [worker.sentinel for worker_id, worker in enumerate(self.workers) if self.alive[worker_id]]
+
+            wait(conns + sentinels + [self.wakeup_reader], timeout=self._next_respawn_delay())
+            if self.wakeup_reader.poll():
+                self.wakeup_reader.recv()
+
+            for worker_id in range(self.num_workers):
+                if self.alive[worker_id]:
+                    self._receive_results(worker_id)
+                    if not self.workers[worker_id].is_alive():
+                        self._worker_exited(worker_id)
+                elif self.respawn_at[worker_id] is not None and time.monotonic() >= self.respawn_at[worker_id]:
+                    with self.spawn_lock:
+                        if self.stopping.is_set():
+                            self.respawn_at[worker_id] = None
+                            continue
+                        self.restarts[worker_id] += 1
+                        self._spawn_worker(worker_id, self.respawn_context)
+
+    def _next_respawn_delay(self):
+        due = [when for when in self.respawn_at if when is not None]
+        if not due:
+            return 1.0
+        return min(1.0, max(0.0, min(due) - time.monotonic()))
+
+    def _receive_results(self, worker_id):
+        conn = self.result_conns[worker_id]
+        try:
+            while conn.poll():
+                self._resolve(*conn.recv())
+        except (EOFError, OSError):
+            pass
+
+    def _resolve(self, task_id, body, error, invalid_image):
+        with self.lock:
+            if task_id not in self.pending:
+                return
+            worker_id, future = self.pending.pop(task_id)
+            self.in_flight[worker_id] -= 1
+
+        if invalid_image:
+            future.set_exception(InvalidImageError(error))
+        elif error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(body)
+
+    def _worker_exited(self, worker_id):
+        worker = self.workers[worker_id]
+        with self.lock:
+            self.alive[worker_id] = False
+            task_queue = self.task_queues[worker_id]
+        task_queue.cancel_join_thread()
+        task_queue.close()
+        self.result_conns[worker_id].close()
+        self._fail_pending([worker_id], "Inference worker exited")
+
+        if self.stopping.is_set():
+            return
+
+        # Do not fork in a tight loop if the worker dies on startup
+        delay = 1.0 if time.monotonic() - self.started_at[worker_id] < 1.0 else 0.0
+        self.respawn_at[worker_id] = time.monotonic() + delay
+        print(f"Worker {worker_id} exited with code {worker.exitcode}, restarting")
+
+    def _fail_pending(self, worker_ids, message):
+        worker_ids = set(worker_ids)
+        with self.lock:
+            failed = [task_id for task_id, (worker_id, _) in self.pending.items() if worker_id in worker_ids]
+            futures = [self.pending.pop(task_id)[1] for task_id in failed]
+            for worker_id in worker_ids:
+                self.in_flight[worker_id] = 0
+
+        for future in futures:
+            future.set_exception(WorkerUnavailableError(message))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': [
+                    {
+                        'pid': worker.pid,
+                        'cpus': sorted(cpus),
+                        'alive': self.alive[worker_id],
+                        'in_flight': self.in_flight[worker_id],
+                        'restarts': self.restarts[worker_id]
+                    }
+                    for worker_id, (worker, cpus) in enumerate(zip(self.workers, self.cpu_sets))
+                ]
+            }
+
+def create_app(server):
+    app = Flask(__name__)
+
+    @app.route('/predict', methods=['POST'])
+    def predict():
+        image = request.files.get('image')
+        if image is None:
+            return jsonify({'error': 'No image provided'}), 400
+
+        try:
+            body = server.predict(image.read(), timeout=Config.SERVING_REQUEST_TIMEOUT)
+        except InvalidImageError as e:
+            return jsonify({'error': str(e)}), 400
+        except FutureTimeoutError:
+            return jsonify({'error': 'Inference timed out'}), 504
+        except WorkerUnavailableError as e:
+            return jsonify({'error': str(e)}), 503
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+        return Response(body, mimetype='application/json')
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify(server.stats())
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default=os.environ.get('MODEL_PATH'))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads_per_worker', type=int, default=Config.SERVING_THREADS_PER_WORKER)
+    parser.add_argument('--port', type=int, default=Config.SERVING_PORT)
+    args = parser.parse_args()
+
+    if args.model_path is None or not os.path.exists(args.model_path):
+        print(f"Model not found at {args.model_path}")
+        return
+
+    server = PreforkServer(args.model_path, args.workers, args.threads_per_worker)
+    server.start()
+    print(f"Started {server.num_workers} workers with {server.threads_per_worker} threads each")
+
+    try:
+        create_app(server).run(host='0.0.0.0', port=args.port, threaded=True)
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
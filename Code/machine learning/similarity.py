@@ -0,0 +1,370 @@
+import os
+import numpy as np
+from config import Config
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _nearest_centroid(x, centroids, centroid_norms, chunk_size=65536):
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start:start + chunk_size]
+        dists = centroid_norms[None, :] - 2 * (chunk @ centroids.T)
+        assign[start:start + chunk_size] = np.argmin(dists, axis=1)
+    return assign
+
+def _kmeans(x, k, n_iter, rng):
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assign = _nearest_centroid(x, centroids, (centroids ** 2).sum(axis=1))
+        counts = np.bincount(assign, minlength=k)
+
+        # Sum every cluster in one pass over the points sorted by assignment
+        order = np.argsort(assign, kind='stable')
+        nonempty = np.flatnonzero(counts)
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        centroids[nonempty] = np.add.reduceat(x[order], starts, axis=0) / counts[nonempty, None]
+
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), size=len(empty), replace=False)]
+
+    return centroids
+
+def _top_k(scores, k):
+    if k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+class EmbeddingStore:
+    # Single writer: rows in vectors.f32 and lines in scan_ids.txt are kept in
+    # step by this process, and reconciled on open after an interrupted write.
+    def __init__(self, store_dir=None, dim=None):
+        self.store_dir = store_dir or Config.EMBEDDINGS_DIR
+        self.dim = dim or Config.EMBEDDING_DIM
+        self.vectors_path = os.path.join(self.store_dir, 'vectors.f32')
+        self.ids_path = os.path.join(self.store_dir, 'scan_ids.txt')
+        self.row_bytes = self.dim * np.dtype(np.float32).itemsize
+
+        self._mmap = None
+        self._scan_ids = []
+        self._scan_id_set = None
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._reconcile()
+
+    def __len__(self):
+        if not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // self.row_bytes
+
+    def _read_scan_ids(self):
+        if not os.path.exists(self.ids_path):
+            return []
+        with open(self.ids_path) as f:
+            # The last element is either empty or a line cut off mid-write
+            return f.read().split('\n')[:-1]
+
+    def _reconcile(self):
+        scan_ids = self._read_scan_ids()
+        n = min(len(self), len(scan_ids))
+
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(n * self.row_bytes)
+
+        # Rewrite whenever the file holds anything past the last complete row,
+        # including a partial trailing line
+        ids_size = os.path.getsize(self.ids_path) if os.path.exists(self.ids_path) else 0
+        expected_size = sum(len(scan_id.encode()) + 1 for scan_id in scan_ids[:n])
+        if ids_size != expected_size:
+            with open(self.ids_path, 'w') as f:
+                f.writelines(f"{scan_id}\n" for scan_id in scan_ids[:n])
+
+        self._scan_ids = scan_ids[:n]
+        self._scan_id_set = None
+        self._mmap = None
+
+    def __contains__(self, scan_id):
+        scan_ids = self.scan_ids
+        if self._scan_id_set is None or len(self._scan_id_set) < len(scan_ids):
+            self._scan_id_set = set(scan_ids)
+        return str(scan_id) in self._scan_id_set
+
+    @property
+    def vectors(self):
+        n = len(self)
+        if n == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        if self._mmap is None or self._mmap.shape[0] != n:
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(n, self.dim))
+        return self._mmap
+
+    @property
+    def scan_ids(self):
+        # Appends from this store extend the cache; only a reader that sees
+        # rows written by another process has to re-read the file
+        if len(self._scan_ids) < len(self):
+            self._scan_ids = self._read_scan_ids()
+        return self._scan_ids
+
+    def append(self, vectors, scan_ids):
+        vectors = normalize(vectors)
+        scan_ids = [str(scan_id) for scan_id in scan_ids]
+
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of size {self.dim}, got {vectors.shape[1]}")
+        if len(scan_ids) != len(vectors):
+            raise ValueError(f"Got {len(vectors)} embeddings but {len(scan_ids)} scan ids")
+        for scan_id in scan_ids:
+            if '\n' in scan_id or '\r' in scan_id:
+                raise ValueError(f"Scan id {scan_id!r} contains a line break")
+
+        if len(self) != len(self._scan_ids):
+            self._reconcile()
+        start = len(self._scan_ids)
+
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+
+        with open(self.ids_path, 'a') as f:
+            f.writelines(f"{scan_id}\n" for scan_id in scan_ids)
+
+        self._scan_ids.extend(scan_ids)
+        if self._scan_id_set is not None:
+            self._scan_id_set.update(scan_ids)
+        return np.arange(start, start + len(vectors))
+
+class IVFIndex:
+    # Inverted file index over PCA-reduced codes. Probed lists are scored on
+    # the reduced codes and the best candidates are re-ranked exactly against
+    # the memory-mapped store.
+    def __init__(self, store, nlist=None, nprobe=None, pca_dim=None):
+        self.store = store
+        self.nlist = nlist or Config.SIMILARITY_NLIST
+        self.nprobe = nprobe or Config.SIMILARITY_NPROBE
+        self.pca_dim = min(pca_dim or Config.SIMILARITY_PCA_DIM, store.dim)
+
+        self.mean = None
+        self.components = None
+        self.centroids = None
+        self.ntotal = 0
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, sample_size=100000, n_iter=20, seed=Config.RANDOM_SEED):
+        n = len(self.store)
+        if n == 0:
+            raise ValueError("Cannot train the index on an empty embedding store")
+
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(n, size=min(sample_size, n), replace=False))
+        sample = np.asarray(self.store.vectors[rows])
+
+        self.mean = sample.mean(axis=0)
+        centered = sample - self.mean
+        _, eigvecs = np.linalg.eigh(centered.T @ centered)
+        self.components = np.ascontiguousarray(eigvecs[:, ::-1][:, :self.pca_dim], dtype=np.float32)
+
+        codes = centered @ self.components
+        self.nlist = min(self.nlist, len(codes))
+        self.centroids = _kmeans(codes, self.nlist, n_iter, rng)
+        self._prepare()
+        self._reset_lists()
+
+    def _prepare(self):
+        self.centroid_norms = (self.centroids ** 2).sum(axis=1)
+        self.mean_code = self.mean @ self.components
+
+    def _reset_lists(self):
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+        self.list_codes = [np.empty((0, self.pca_dim), dtype=np.float32) for _ in range(self.nlist)]
+        self.list_sizes = np.zeros(self.nlist, dtype=np.int64)
+        self.ntotal = 0
+
+    def _append_to_list(self, list_no, ids, codes):
+        size = self.list_sizes[list_no]
+        needed = size + len(ids)
+
+        if needed > len(self.list_ids[list_no]):
+            capacity = max(needed, 2 * len(self.list_ids[list_no]), 16)
+
+            grown_ids = np.empty(capacity, dtype=np.int64)
+            grown_ids[:size] = self.list_ids[list_no][:size]
+            self.list_ids[list_no] = grown_ids
+
+            grown_codes = np.empty((capacity, self.pca_dim), dtype=np.float32)
+            grown_codes[:size] = self.list_codes[list_no][:size]
+            self.list_codes[list_no] = grown_codes
+
+        self.list_ids[list_no][size:needed] = ids
+        self.list_codes[list_no][size:needed] = codes
+        self.list_sizes[list_no] = needed
+
+    def sync(self, chunk_size=65536):
+        if not self.is_trained:
+            raise RuntimeError("Index must be trained before vectors can be added")
+
+        n = len(self.store)
+        vectors = self.store.vectors
+        added = n - self.ntotal
+
+        for start in range(self.ntotal, n, chunk_size):
+            end = min(start + chunk_size, n)
+            codes = (np.asarray(vectors[start:end]) - self.mean) @ self.components
+            assign = _nearest_centroid(codes, self.centroids, self.centroid_norms)
+
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=self.nlist)
+            offsets = np.cumsum(counts) - counts
+            for list_no in np.flatnonzero(counts):
+                members = order[offsets[list_no]:offsets[list_no] + counts[list_no]]
+                self._append_to_list(list_no, start + members, codes[members])
+
+            self.ntotal = end
+
+        return added
+
+    def add(self, vectors, scan_ids):
+        # Until there are enough scans to train on, embeddings are only stored;
+        # train() followed by sync() indexes everything appended so far
+        rows = self.store.append(vectors, scan_ids)
+        if self.is_trained:
+            self.sync()
+        return rows
+
+    def search_rows(self, query, k=10, nprobe=None, rerank=None):
+        # Small stores are not worth an index yet, and an exact scan over them
+        # is still fast
+        if not self.is_trained:
+            rows, scores = brute_force_search_rows(self.store, query, k)
+            return rows[0], scores[0]
+
+        query = normalize(query)[0]
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+
+        # Inner products against the stored vectors only differ by a constant
+        # from inner products against the centered codes, so the uncentered
+        # projection ranks candidates while the centered one picks the lists.
+        projected = query @ self.components
+        dists = self.centroid_norms - 2 * (self.centroids @ (projected - self.mean_code))
+        probe = _top_k(-dists, nprobe)
+
+        ids = [self.list_ids[l][:self.list_sizes[l]] for l in probe]
+        scores = [self.list_codes[l][:self.list_sizes[l]] @ projected for l in probe]
+        ids = np.concatenate(ids)
+        scores = np.concatenate(scores)
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        candidates = np.sort(ids[_top_k(scores, rerank or max(Config.SIMILARITY_RERANK, 2 * k))])
+        exact = np.asarray(self.store.vectors[candidates]) @ query
+        best = _top_k(exact, k)
+
+        return candidates[best], exact[best]
+
+    def search(self, query, k=10, nprobe=None, rerank=None):
+        rows, scores = self.search_rows(query, k, nprobe, rerank)
+        scan_ids = self.store.scan_ids
+
+        results = []
+        for i, (row, score) in enumerate(zip(rows, scores)):
+            results.append({
+                'rank': i + 1,
+                'scan_id': scan_ids[row],
+                'similarity': float(score)
+            })
+
+        return results
+
+    def save(self, path=None):
+        if path is None:
+            path = Config.SIMILARITY_INDEX_PATH
+
+        np.savez(
+            path,
+            mean=self.mean,
+            components=self.components,
+            centroids=self.centroids,
+            nprobe=self.nprobe,
+            list_sizes=self.list_sizes,
+            list_ids=np.concatenate([ids[:size] for ids, size in zip(self.list_ids, self.list_sizes)]),
+            list_codes=np.concatenate([codes[:size] for codes, size in zip(self.list_codes, self.list_sizes)])
+        )
+
+    @classmethod
+    def load(cls, store, path=None):
+        if path is None:
+            path = Config.SIMILARITY_INDEX_PATH
+
+        data = np.load(path)
+        index = cls(store, nlist=len(data['centroids']), nprobe=int(data['nprobe']),
+                    pca_dim=data['components'].shape[1])
+        index.mean = data['mean']
+        index.components = data['components']
+        index.centroids = data['centroids']
+        index._prepare()
+        index._reset_lists()
+
+        offsets = np.cumsum(data['list_sizes'])
+        index.list_ids = np.split(data['list_ids'], offsets[:-1])
+        index.list_codes = np.split(data['list_codes'], offsets[:-1])
+        index.list_sizes = data['list_sizes'].copy()
+        index.ntotal = int(offsets[-1]) if len(offsets) else 0
+
+        # Pick up scans appended to the store after the index was saved
+        index.sync()
+        return index
+
+def open_index(store_dir=None, index_path=None):
+    if index_path is None:
+        index_path = Config.SIMILARITY_INDEX_PATH
+
+    store = EmbeddingStore(store_dir)
+    if os.path.exists(index_path):
+        return IVFIndex.load(store, index_path)
+    return IVFIndex(store)
+
+def save_index(index, index_path=None, min_train_size=None):
+    # Train once enough scans have been stored; k-means needs a few dozen
+    # points per list before the lists mean anything
+    if min_train_size is None:
+        min_train_size = Config.SIMILARITY_MIN_TRAIN_SIZE
+
+    if not index.is_trained:
+        if len(index.store) < min_train_size:
+            return False
+        index.train()
+        index.sync()
+
+    index.save(index_path)
+    return True
+
+def brute_force_search_rows(store, queries, k=10, chunk_size=65536):
+    queries = normalize(queries)
+    vectors = store.vectors
+
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+
+    for start in range(0, len(vectors), chunk_size):
+        chunk_scores = queries @ np.asarray(vectors[start:start + chunk_size]).T
+        chunk_rows = np.broadcast_to(np.arange(start, start + chunk_scores.shape[1]), chunk_scores.shape)
+
+        scores = np.concatenate([best_scores, chunk_scores], axis=1)
+        rows = np.concatenate([best_rows, chunk_rows], axis=1)
+        keep = min(k, scores.shape[1])
+        top = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_rows = np.take_along_axis(rows, top, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)